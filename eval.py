@@ -45,9 +45,9 @@ def evaluate(gcn_c: torch.nn.Module,
         all_predictions = torch.tensor([], dtype=torch.long, device='cuda')
 
     if full_batch:
-        # perform full batch message passing for evaluation
-
-        logits_total, _ = gcn_c(x, edge_index)
+        # perform full batch message passing for evaluation, with the same
+        # adjacency for every layer of the classifier
+        logits_total = gcn_c(x, [edge_index] * args.sampling_hops)
         if data.y[mask].dim() == 1:
             predictions = torch.argmax(logits_total, dim=1)[mask].cpu()
             targets = data.y[mask]
@@ -118,7 +118,7 @@ def evaluate(gcn_c: torch.nn.Module,
                     x = data.x[batch_nodes].to(device)
 
                 # Get probabilities for sampling each node
-                node_logits, _ = gcn_gf(x, local_neighborhoods)
+                node_logits = gcn_gf(x, local_neighborhoods)
                 # Select logits for neighbor nodes only
                 node_logits = node_logits[node_map.map(neighbor_nodes)]
 
@@ -150,7 +150,7 @@ def evaluate(gcn_c: torch.nn.Module,
             edge_indices = [node_map.map(e).to(device) for e in global_edge_indices]
 
             x = data.x[all_nodes].to(device)
-            logits_total, _ = gcn_c(x, edge_indices)
+            logits_total = gcn_c(x, edge_indices)
             predictions = torch.argmax(logits_total, dim=1)
             predictions = predictions[node_map.map(target_nodes)]  # map back to original node IDs
 
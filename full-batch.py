@@ -7,6 +7,7 @@ import torch
 import torch.nn as nn
 import torch_geometric
 import wandb
+from torch_sparse import SparseTensor
 from sklearn.metrics import accuracy_score, f1_score
 from tap import Tap
 from torch.distributions import Bernoulli
@@ -69,7 +70,9 @@ def train(args: Arguments):
         num_indicators = 0
 
     if args.model_type == 'gcn':
-        gcn_c = GCN(data.num_features, hidden_dims=[args.hidden_dim, num_classes], dropout=args.dropout).to(device)
+        # The graph is the same in every epoch, so its normalization is cached
+        gcn_c = GCN(data.num_features, hidden_dims=[args.hidden_dim, num_classes], dropout=args.dropout,
+                    cached=True).to(device)
     elif args.model_type == 'graphsage':
         gcn_c = GraphSAGE(data.num_features, hidden_dims=[args.hidden_dim, num_classes], dropout=args.dropout).to(device)
 
@@ -93,6 +96,13 @@ def train(args: Arguments):
                                data.edge_index),
                               shape=(data.num_nodes, data.num_nodes))
 
+    # The full graph is moved to the device once, with its transposed
+    # adjacency in CSR format
+    x = data.x.to(device)
+    row, col = data.edge_index
+    adj_t = SparseTensor(row=col, col=row,
+                         sparse_sizes=(data.num_nodes, data.num_nodes)).to(device)
+
     logger.info('Training')
     for epoch in range(1, args.max_epochs + 1):
         acc_loss_gfn = 0
@@ -100,8 +110,7 @@ def train(args: Arguments):
         acc_loss_binom = 0
 
         with tqdm(total=len(train_loader), desc=f'Epoch {epoch}') as bar:
-            x = data.x.to(device)
-            logits, gcn_mem_alloc = gcn_c(x, data.edge_index.to(device))
+            logits = gcn_c(x, adj_t)
             loss_c = loss_fn(logits[data.train_mask], data.y[data.train_mask].to(device))
 
             optimizer_c.zero_grad()
@@ -128,8 +137,7 @@ def train(args: Arguments):
                         f'valid_f1={f1:.3f}')
             wandb.log(log_dict)
 
-    x = data.x.to(device)
-    logits, gcn_mem_alloc = gcn_c(x, data.edge_index.to(device))
+    logits = gcn_c(x, adj_t)
     test_predictions = torch.argmax(logits, dim=1)[data.test_mask].cpu()
     targets = data.y[data.test_mask]
     test_accuracy = accuracy_score(targets, test_predictions)
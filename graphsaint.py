@@ -1,47 +1,223 @@
 import argparse
 import os
+from importlib.metadata import version
+
+# Subgraphs have a different size in every batch, so large cached blocks are
+# not split to serve them. Expandable segments let the allocator grow existing
+# segments instead of reserving new ones for each irregularly sized batch
+# (PyTorch >= 2.1). Both options go in one setting, which must be made before
+# torch is imported, and a setting given by the user is left as it is.
+if 'PYTORCH_CUDA_ALLOC_CONF' not in os.environ:
+    alloc_conf = 'max_split_size_mb:128'
+    if tuple(int(v) for v in version('torch').split('.')[:2]) >= (2, 1):
+        alloc_conf += ',expandable_segments:True'
+    os.environ['PYTORCH_CUDA_ALLOC_CONF'] = alloc_conf
 
 import torch
 import torch.nn as nn
 
+from torch_geometric.data import Batch, Data
 from torch_geometric.loader import GraphSAINTNodeSampler
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+from torch_sparse import SparseTensor
 from modules.gcn import GCN
-from modules.data import get_data
+from modules.data import get_data, quantize_features
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--use_normalization', action='store_true')
 parser.add_argument('--hidden_dim', default=256, type=int)
 parser.add_argument('--dataset', type=str)
 parser.add_argument('--runs', default=1, type=int)
+parser.add_argument('--num_workers', default=4, type=int)
+# torch.compile and TorchScript are alternatives, and are not combined
+compiler = parser.add_mutually_exclusive_group()
+compiler.add_argument('--compile', action='store_true')
+compiler.add_argument('--jit', action='store_true')
+parser.add_argument('--bf16', action='store_true')
+parser.add_argument('--quantize_features', action='store_true')
+parser.add_argument('--reorder', action='store_true')
+parser.add_argument('--cuda_graph', action='store_true')
+parser.add_argument('--num_steps', default=1, type=int)
+parser.add_argument('--micro_batches', default=1, type=int,
+                    help='subgraphs merged into each forward pass. The '
+                         'subgraphs per epoch, --num_steps, are rounded up '
+                         'to a multiple of it, so with the default of one '
+                         'step an epoch trains on micro_batches subgraphs')
 args = parser.parse_args()
 
+# Use TF32 tensor cores for the dense transforms in the layers on Ampere and
+# newer GPUs, and let cuDNN pick the fastest algorithms for fixed shapes
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
 
-def train(model, loader, loss_fn):
-    model.train()
-    total_loss = total_examples = 0
-    for batch in loader:
-        batch = batch.to(device)
-        optimizer.zero_grad()
 
-        out = model(batch.x, batch.edge_index)
-        train_idx = batch.train_mask.nonzero().squeeze(1)
-        loss = loss_fn(out[train_idx],
-                                   batch.y[train_idx])
+class GraphSAINTCSRSampler(GraphSAINTNodeSampler):
+    """GraphSAINT node sampler whose subgraphs carry their transposed
+    adjacency in CSR format, adj_t, instead of an edge index. The adjacency is
+    normalized with gcn_norm and its values are cast to dtype.
+
+    Every batch merges micro_batches subgraphs into a single graph with a
+    block-diagonal adjacency, so that they are processed in one forward pass.
+    The number of training nodes in the batch is stored in n_train. The
+    conversion and the merge run in the loader workers."""
+    def __init__(self, data, batch_size, dtype=torch.float, micro_batches=1,
+                 **kwargs):
+        self.dtype = dtype
+        self.micro_batches = micro_batches
+        super().__init__(data, batch_size, **kwargs)
+
+    def __getitem__(self, idx):
+        return [super(GraphSAINTCSRSampler, self).__getitem__(idx)
+                for _ in range(self.micro_batches)]
+
+    def __collate__(self, data_list):
+        subgraphs = []
+        for sample in data_list[0]:
+            data = super().__collate__([sample])
+            row, col = data.edge_index
+            adj_t = SparseTensor(row=col, col=row,
+                                 sparse_sizes=(data.num_nodes, data.num_nodes))
+            data.adj_t = gcn_norm(adj_t).type(self.dtype)
+            del data.edge_index
+            subgraphs.append(data)
+
+        if len(subgraphs) == 1:
+            batch = subgraphs[0]
+        else:
+            # Normalizing each block is the same as normalizing the merged graph
+            batch = Batch.from_data_list(subgraphs)
+        batch.n_train = batch.train_mask.sum()
+        return batch
+
+
+def train_step(model, x, adj_t, y, train_mask, n_train, loss_fn):
+    # The autocast cache cannot be used while capturing a CUDA graph
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16,
+                        cache_enabled=False):
+        out = model(x, adj_t)
+    # Weight the per-node loss by the training mask instead of gathering
+    # the training nodes, which needs a sync to find out how many there are
+    node_loss = loss_fn(out, y)
+    if node_loss.dim() > 1:
+        node_loss = node_loss.mean(dim=-1)
+    loss = (node_loss * train_mask).sum() / n_train.clamp_min(1)
+
+    loss.backward()
+    optimizer.step()
+    return loss.detach()
+
+
+class CUDAGraphTrainStep:
+    """A training step captured in a CUDA graph, replayed for every batch to
+    avoid launching its kernels one by one.
+
+    Batches are copied into static buffers with room for num_nodes - 1 nodes
+    and nnz adjacency entries. The adjacency is padded with zero-valued
+    entries on the last node, which is never a node of the batch, and the
+    padded nodes are left out of the loss by the training mask.
+    The optimizer must be created with capturable=True.
+    """
+    def __init__(self, model, loss_fn, example, num_nodes, nnz):
+        self.num_nodes = num_nodes
+        self.nnz = nnz
+        self.x = example.x.new_zeros((num_nodes,) + example.x.shape[1:])
+        self.y = example.y.new_zeros((num_nodes,) + example.y.shape[1:])
+        self.train_mask = torch.zeros(num_nodes, device=example.x.device)
+        self.n_train = torch.zeros((), dtype=torch.long,
+                                   device=example.x.device)
+
+        # Build all the indices that the SpMM and its backward pass need, so
+        # that they are read from the static buffers instead of computed
+        # once at capture time
+        self.adj_t = self.pad(example.adj_t)
+        storage = self.adj_t.storage
+        self.buffers = [storage.row(), storage.rowptr(), storage.col(),
+                        storage.value(), storage.colptr(), storage.csr2csc()]
+
+        # Warm up on a side stream with an empty training mask, which leaves
+        # the parameters unchanged, then reset the step of the optimizer
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                optimizer.zero_grad(set_to_none=True)
+                train_step(model, self.x, self.adj_t, self.y, self.train_mask,
+                           self.n_train, loss_fn)
+        torch.cuda.current_stream().wait_stream(stream)
+        for state in optimizer.state.values():
+            state['step'].zero_()
+
+        self.graph = torch.cuda.CUDAGraph()
+        optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(self.graph):
+            self.loss = train_step(model, self.x, self.adj_t, self.y,
+                                   self.train_mask, self.n_train, loss_fn)
+
+    def pad(self, adj_t):
+        row, col, value = adj_t.coo()
+        padding = row.new_full((self.nnz - row.numel(),), self.num_nodes - 1)
+        return SparseTensor(row=torch.cat([row, padding]),
+                            col=torch.cat([col, padding]),
+                            value=torch.cat([value, value.new_zeros(padding.numel())]),
+                            sparse_sizes=(self.num_nodes, self.num_nodes),
+                            is_sorted=True)
 
-        loss.backward()
-        optimizer.step()
-        total_loss += loss.item() * data.num_nodes
-        total_examples += data.num_nodes
-    return total_loss / total_examples
+    def fits(self, batch):
+        return batch.num_nodes < self.num_nodes and batch.adj_t.nnz() <= self.nnz
 
+    def __call__(self, batch):
+        n = batch.num_nodes
+        self.x[:n].copy_(batch.x)
+        self.y[:n].copy_(batch.y)
+        self.train_mask.zero_()
+        self.train_mask[:n].copy_(batch.train_mask)
+        self.n_train.copy_(batch.n_train)
 
-@torch.no_grad()
+        storage = self.pad(batch.adj_t).storage
+        padded = [storage.row(), storage.rowptr(), storage.col(),
+                  storage.value(), storage.colptr(), storage.csr2csc()]
+        for buffer, value in zip(self.buffers, padded):
+            buffer.copy_(value)
+
+        self.graph.replay()
+        return self.loss
+
+
+def train(model, loader, loss_fn, graph_step=None):
+    model.train()
+    # The loss is accumulated on the device, weighted by the number of
+    # training nodes in each batch, and synced once per epoch
+    total_loss = torch.zeros((), device=device)
+    total_examples = torch.zeros((), dtype=torch.long, device=device)
+    # Fetch the next batch from the workers while the current one is copied
+    # and processed on the device
+    batches = iter(loader)
+    next_batch = next(batches, None)
+    while next_batch is not None:
+        batch = next_batch.to(device, non_blocking=True)
+        next_batch = next(batches, None)
+
+        if graph_step is not None and graph_step.fits(batch):
+            loss = graph_step(batch)
+        else:
+            # Gradients are zeroed in place, as the CUDA graph holds on to them
+            optimizer.zero_grad(set_to_none=False)
+            loss = train_step(model, batch.x, batch.adj_t, batch.y,
+                              batch.train_mask, batch.n_train, loss_fn)
+        total_loss += loss * batch.n_train
+        total_examples += batch.n_train
+    return (total_loss / total_examples.clamp_min(1)).item()
+
+
+@torch.inference_mode()
 def test(model, data):
     model.eval()
-    out = model(data.x.to('cpu'), data.edge_index.to('cpu'))
+    with torch.autocast(device.type, dtype=torch.bfloat16, enabled=args.bf16):
+        out = model(data.x, data.adj_t)
     if data.y.dim() == 1:
         pred = out.argmax(dim=-1)
-        correct = pred.eq(data.y.to('cpu'))
+        correct = pred.eq(data.y)
 
         # accs = []
         # train_acc = correct[data.train_mask].float().mean().item()
@@ -50,12 +226,14 @@ def test(model, data):
 
     # multilabel classification
     else:
-        y_pred = out > 0
-        y_true = data.y > 0.5
+        y_pred = out[data.test_mask] > 0
+        y_true = data.y[data.test_mask] > 0.5
 
-        tp = int((y_true[data.test_mask].to('cpu') & y_pred[data.test_mask].to('cpu')).sum())
-        fp = int((~y_true[data.test_mask].to('cpu') & y_pred[data.test_mask].to('cpu')).sum())
-        fn = int((y_true[data.test_mask].to('cpu') & ~y_pred[data.test_mask].to('cpu')).sum())
+        # Only the three counts are copied back to the host
+        tp = (y_true & y_pred).sum()
+        fp = (~y_true & y_pred).sum()
+        fn = (y_true & ~y_pred).sum()
+        tp, fp, fn = torch.stack([tp, fp, fn]).tolist()
 
         try:
             precision = tp / (tp + fp)
@@ -70,23 +248,81 @@ def test(model, data):
 results = torch.empty(args.runs)
 for run in range(args.runs):
     path = os.path.join(os.getcwd(), 'data', args.dataset)
-    data, num_features, num_classes = get_data(root=path, name=args.dataset)
+    data, num_features, num_classes = get_data(root=path, name=args.dataset,
+                                               reorder=args.reorder)
     row, col = data.edge_index
 
-    loader = GraphSAINTNodeSampler(data, batch_size=768)
+    feature_scale = None
+    if args.quantize_features:
+        # Sampled features are copied to the device as int8, and recovered in
+        # the first layer of the model
+        data.x, feature_scale = quantize_features(data.x)
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # Adjacency values must have the same type as the features they aggregate,
+    # and the layers compute in bfloat16 under autocast
+    adj_dtype = torch.bfloat16 if args.bf16 else torch.float
+
+    # Subgraphs are merged in groups of micro_batches, keeping the number of
+    # subgraphs per epoch at num_steps, rounded up to a full group
+    batch_size = 768
+    num_steps = -(-args.num_steps // args.micro_batches)
+
+    # Subgraphs are sampled in persistent worker processes and collated into
+    # pinned memory, so that they can be copied asynchronously to the device.
+    loader = GraphSAINTCSRSampler(data, batch_size=batch_size, dtype=adj_dtype,
+                                  num_steps=num_steps,
+                                  micro_batches=args.micro_batches,
+                                  num_workers=args.num_workers,
+                                  persistent_workers=args.num_workers > 0,
+                                  pin_memory=device.type == 'cuda')
 
     if data.y.dim() == 1:
-        loss_fn = nn.CrossEntropyLoss()
+        loss_fn = nn.CrossEntropyLoss(reduction='none')
     else:
-        loss_fn = nn.BCEWithLogitsLoss()
+        loss_fn = nn.BCEWithLogitsLoss(reduction='none')
 
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    model = GCN(data.num_features, hidden_dims=[args.hidden_dim, num_classes]).to(device)
-    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+    # Keep the full graph for evaluation on the device, with its normalized
+    # adjacency in CSR format, so that it is built once and reused every epoch
+    adj_t = SparseTensor(row=col, col=row,
+                         sparse_sizes=(data.num_nodes, data.num_nodes))
+    eval_data = Data(x=data.x, y=data.y, test_mask=data.test_mask.bool(),
+                     adj_t=adj_t).to(device)
+    eval_data.adj_t = gcn_norm(eval_data.adj_t).type(adj_dtype)
+
+    # All adjacencies are normalized before they reach the model, and are
+    # always given as a SparseTensor
+    jittable = '(Tensor, SparseTensor, OptTensor) -> Tensor' if args.jit else None
+    model = GCN(data.num_features, hidden_dims=[args.hidden_dim, num_classes],
+                normalize=False, feature_scale=feature_scale,
+                jittable=jittable).to(device)
+    use_cuda_graph = args.cuda_graph and device.type == 'cuda'
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001,
+                                 capturable=use_cuda_graph)
+
+    train_model = eval_model = model
+    if args.compile:
+        # Both share the parameters of the model. Subgraphs change size in
+        # every batch, while the full graph used for evaluation is fixed.
+        train_model = torch.compile(model, dynamic=True)
+        eval_model = torch.compile(model, mode='max-autotune')
+
+    graph_step = None
+    if use_cuda_graph:
+        # The sampler draws at most batch_size distinct nodes per subgraph.
+        # Leave room for batches with more edges than the first one, and
+        # train the rest eagerly.
+        model.train()
+        example = next(iter(loader)).to(device)
+        graph_step = CUDAGraphTrainStep(model, loss_fn, example,
+                                        num_nodes=batch_size * args.micro_batches + 1,
+                                        nnz=2 * example.adj_t.nnz())
 
     for epoch in range(1, 101):
-        loss = train(model, loader, loss_fn)
-        accs = test(model, data)
+        loss = train(train_model, loader, loss_fn, graph_step)
+        accs = test(eval_model, eval_data)
+        # Release the activations of the full graph before the next epoch
+        torch.cuda.empty_cache()
         print(f'Epoch: {epoch:02d}, Loss: {loss:.4f}, Test: {accs:.4f}')
 
     results[run] = accs
@@ -68,12 +68,14 @@ def train(args: Arguments):
         num_indicators = 0
 
     if args.model_type == 'gcn':
-        gcn_c = GCN(data.num_features, hidden_dims=[args.hidden_dim, num_classes], dropout=args.dropout).to(device)
+        gcn_c = GCN(data.num_features, hidden_dims=[args.hidden_dim, num_classes], dropout=args.dropout,
+                    layerwise_adjacency=True).to(device)
         # GCN model for GFlotNet sampling
         gcn_gf = GCN(data.num_features + num_indicators,
                       hidden_dims=[args.hidden_dim, 1]).to(device)
     elif args.model_type == 'graphsage':
-        gcn_c = GraphSAGE(data.num_features, hidden_dims=[args.hidden_dim, num_classes], dropout=args.dropout).to(device)
+        gcn_c = GraphSAGE(data.num_features, hidden_dims=[args.hidden_dim, num_classes], dropout=args.dropout,
+                          layerwise_adjacency=True).to(device)
         # GCN model for GFlotNet sampling
         gcn_gf = GCN(data.num_features + num_indicators,
                       hidden_dims=[args.hidden_dim, 1]).to(device)
@@ -171,7 +173,7 @@ def train(args: Arguments):
                     else:
                         x = data.x[batch_nodes].to(device)
                     # Get probabilities for sampling each node
-                    node_logits, _ = gcn_gf(x, local_neighborhoods)
+                    node_logits = gcn_gf(x, local_neighborhoods)
                     # Select logits for neighbor nodes only
                     node_logits = node_logits[node_map.map(neighbor_nodes)]
                     
@@ -211,7 +213,9 @@ def train(args: Arguments):
                 edge_indices = [node_map.map(e).to(device) for e in global_edge_indices]
 
                 x = data.x[all_nodes].to(device)
-                logits, gcn_mem_alloc = gcn_c(x, edge_indices)
+                logits = gcn_c(x, edge_indices)
+                # Memory allocated after the forward pass of the classifier
+                gcn_mem_alloc = torch.cuda.memory_allocated() / (1024 * 1024)
 
                 local_target_ids = node_map.map(target_nodes)
                 loss_c = loss_fn(logits[local_target_ids],
@@ -1,10 +1,15 @@
 # From PyGAS, PyTorch Geometric Auto-Scale: https://github.com/rusty1s/pyg_autoscale/tree/master
+import os
 from typing import Tuple
 
+import numpy as np
+import scipy.sparse as sp
 import torch
 import torch_geometric.transforms as T
+from torch import Tensor
 import torch_geometric.utils as pygutils
 from ogb.nodeproppred import PygNodePropPredDataset
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 from torch_geometric.data import Batch, Data
 from torch_geometric.datasets import (PPI, Amazon, Coauthor, Flickr,
                                       GNNBenchmarkDataset, Planetoid, Reddit2,
@@ -112,8 +117,61 @@ def get_sbm(root: str, name: str) -> Tuple[Data, int, int]:
     return data, dataset.num_features, dataset.num_classes
 
 
-def get_data(root: str, name: str) -> Tuple[Data, int, int]:
-    if name.lower() in ['cora', 'citeseer', 'pubmed']:
+def quantize_features(x: Tensor) -> Tuple[Tensor, Tensor]:
+    """Quantizes node features to int8, with a symmetric scale per feature.
+    The features are recovered as x_int8 * scale."""
+    scale = x.abs().amax(dim=0).clamp_min(1e-8) / 127
+    x_int8 = torch.round(x / scale).clamp(-127, 127).to(torch.int8)
+    return x_int8, scale
+
+
+def reorder_nodes(data: Data) -> Data:
+    """Relabels the nodes of a graph in Reverse Cuthill-McKee order, so that
+    neighbors get nearby indices and aggregation has better memory locality.
+    """
+    if 'adj_t' in data:
+        col, row, _ = data.adj_t.coo()
+    else:
+        row, col = data.edge_index
+    n = data.num_nodes
+    adjacency = sp.csr_matrix((np.ones(row.numel(), dtype=bool),
+                               (row.numpy(), col.numpy())),
+                              shape=(n, n))
+    # perm maps new node IDs to old ones, and inv maps old IDs to new ones
+    perm = torch.from_numpy(reverse_cuthill_mckee(adjacency).astype(np.int64))
+    inv = torch.empty_like(perm)
+    inv[perm] = torch.arange(n)
+
+    for key, item in list(data):
+        if key == 'edge_index':
+            data.edge_index = inv[item]
+        elif key == 'adj_t':
+            data.adj_t = item.permute(perm)
+        elif isinstance(item, Tensor) and data.is_node_attr(key):
+            data[key] = item[perm]
+
+    return data
+
+
+def get_reordered(root: str, name: str) -> Tuple[Data, int, int]:
+    """Loads a dataset with its nodes in Reverse Cuthill-McKee order. The
+    reordered graph is saved in root, so that it is only computed once.
+    Delete the saved file when the loading of the dataset changes."""
+    path = os.path.join(root, f'rcm_{name.lower()}.pt')
+    if os.path.exists(path):
+        # The file holds a pickled Data object, not only tensors
+        return torch.load(path, weights_only=False)
+
+    data, num_features, num_classes = get_data(root, name)
+    data = reorder_nodes(data)
+    torch.save((data, num_features, num_classes), path)
+    return data, num_features, num_classes
+
+
+def get_data(root: str, name: str, reorder: bool = False) -> Tuple[Data, int, int]:
+    if reorder:
+        return get_reordered(root, name)
+    elif name.lower() in ['cora', 'citeseer', 'pubmed']:
         return get_planetoid(root, name)
     elif name.lower() in ['coauthorcs', 'coauthorphysics']:
         return get_coauthor(root, name[8:])
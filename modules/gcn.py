@@ -1,13 +1,32 @@
-from typing import Union
+from typing import Callable, Optional
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn import GATConv, GCN2Conv, GCNConv, Linear,  PNAConv
 from torch_geometric.nn import SAGEConv
+from torch_geometric.typing import Adj
+
+
+def checkpoint_segments(run_layers: Callable, num_layers: int, segments: int,
+                        x: torch.Tensor, *args) -> torch.Tensor:
+    """Runs num_layers layers with run_layers(start, end, x, *args), split
+    into segments, as in torch.utils.checkpoint.checkpoint_sequential. The
+    activations inside all segments but the last one are recomputed in the
+    backward pass instead of being stored."""
+    if num_layers == 0:
+        return x
+    segment_size = -(-num_layers // segments)
+    bounds = list(range(0, num_layers, segment_size)) + [num_layers]
+    for start, end in zip(bounds[:-2], bounds[1:-1]):
+        x = checkpoint(run_layers, start, end, x, *args, use_reentrant=False)
+    return run_layers(bounds[-2], bounds[-1], x, *args)
+
 
 class GraphSAGE(nn.Module):
-    def __init__(self, in_features: int, hidden_dims: list[int], dropout: float=0.):
+    def __init__(self, in_features: int, hidden_dims: list[int], dropout: float=0.,
+                 layerwise_adjacency: bool = False):
         super(GraphSAGE, self).__init__()
         self.dropout = dropout
         dims = [in_features] + hidden_dims
@@ -18,62 +37,95 @@ class GraphSAGE(nn.Module):
         sage_layers.append(SAGEConv(in_channels=dims[-2], out_channels=dims[-1]))
         self.sage_layers = nn.ModuleList(sage_layers)
 
-    def forward(self, x: torch.Tensor, edge_index: Union[torch.Tensor, list[torch.Tensor]]) -> torch.Tensor:
-        layerwise_adjacency = isinstance(edge_index, list)
+        self.forward = self._forward_layerwise if layerwise_adjacency else self._forward_shared
 
+    def _forward_shared(self, x: torch.Tensor, edge_index: Adj) -> torch.Tensor:
+        return self._forward_layerwise(x, [edge_index] * len(self.sage_layers))
+
+    def _forward_layerwise(self, x: torch.Tensor, edge_index: list[Adj]) -> torch.Tensor:
         for i, layer in enumerate(self.sage_layers[:-1], start=1):
-            edges = edge_index[-i] if layerwise_adjacency else edge_index
-            x = torch.relu(layer(x, edges))
+            x = torch.relu(layer(x, edge_index[-i]))
             x = F.dropout(x, p=self.dropout, training=self.training)
 
-        edges = edge_index[0] if layerwise_adjacency else edge_index
-        logits = self.sage_layers[-1](x, edges)
+        logits = self.sage_layers[-1](x, edge_index[0])
         logits = F.dropout(logits, p=self.dropout, training=self.training)
 
-        memory_alloc = torch.cuda.memory_allocated() / (1024 * 1024)
+        return logits
+
+class Dequant(nn.Module):
+    """Recovers floating point features from int8 features quantized with a
+    per-feature scale."""
+    def __init__(self, scale: torch.Tensor):
+        super(Dequant, self).__init__()
+        self.register_buffer('scale', scale)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return x.to(self.scale.dtype) * self.scale
 
-        return logits, memory_alloc
 
 class GCN(nn.Module):
     def __init__(self,
                  in_features: int,
-                 hidden_dims: list[int], dropout: float=0.):
+                 hidden_dims: list[int], dropout: float=0.,
+                 cached: bool = False, normalize: bool = True,
+                 layerwise_adjacency: bool = False,
+                 feature_scale: Optional[torch.Tensor] = None,
+                 jittable: Optional[str] = None):
         super(GCN, self).__init__()
         self.dropout = dropout
+        # Input features are int8 when a quantization scale is given
+        if feature_scale is not None:
+            self.dequant = Dequant(feature_scale)
+        else:
+            self.dequant = nn.Identity()
         dims = [in_features] + hidden_dims
         gcn_layers = []
         for i in range(len(hidden_dims) - 1):
             gcn_layers.append(GCNConv(in_channels=dims[i],
-                                      out_channels=dims[i + 1]))
-
-        gcn_layers.append(GCNConv(in_channels=dims[-2], out_channels=dims[-1]))
+                                      out_channels=dims[i + 1],
+                                      cached=cached, normalize=normalize))
+
+        gcn_layers.append(GCNConv(in_channels=dims[-2], out_channels=dims[-1],
+                                  cached=cached, normalize=normalize))
+        if jittable is not None:
+            # Compile the layers with TorchScript for the given signature,
+            # e.g. '(Tensor, SparseTensor, OptTensor) -> Tensor', so that
+            # message passing does not go through the Python interpreter
+            gcn_layers = [torch.jit.script(layer.jittable(jittable))
+                          for layer in gcn_layers]
         self.gcn_layers = nn.ModuleList(gcn_layers)
 
-    def forward(self,
-                x: torch.Tensor,
-                edge_index: Union[torch.Tensor, list[torch.Tensor]],
-                ) -> torch.Tensor:
-        layerwise_adjacency = type(edge_index) == list
+        # Models take either one adjacency shared by all layers, or a list
+        # with one adjacency per layer. The choice is made here, so that
+        # forward does not check the type of its input on every call.
+        self.forward = self._forward_layerwise if layerwise_adjacency else self._forward_shared
 
+    def _forward_shared(self, x: torch.Tensor, edge_index: Adj) -> torch.Tensor:
+        return self._forward_layerwise(x, [edge_index] * len(self.gcn_layers))
+
+    def _forward_layerwise(self,
+                           x: torch.Tensor,
+                           edge_index: list[Adj],
+                           ) -> torch.Tensor:
+        x = self.dequant(x)
         for i, layer in enumerate(self.gcn_layers[:-1], start=1):
-            edges = edge_index[-i] if layerwise_adjacency else edge_index
-            x = torch.relu(layer(x, edges))
+            # The output of the layer is not needed by autograd, so the ReLU
+            # runs in place, which saves allocating a tensor for its output.
+            # It is not fused with the layer, except under torch.compile.
+            x = layer(x, edge_index[-i]).relu_()
             x = F.dropout(x, p=self.dropout, training=self.training)
 
-        edges = edge_index[0] if layerwise_adjacency else edge_index
-        logits = self.gcn_layers[-1](x, edges)
+        logits = self.gcn_layers[-1](x, edge_index[0])
         logits = F.dropout(logits, p=self.dropout, training=self.training)
 
-        # torch.cuda.synchronize()
-        memory_alloc = torch.cuda.memory_allocated() / (1024 * 1024)
-
-        return logits, memory_alloc
+        return logits
 
 
 class GAT(nn.Module):
     def __init__(self,
                  in_features: int,
-                 hidden_dims: list[int]):
+                 hidden_dims: list[int],
+                 layerwise_adjacency: bool = False):
         super(GAT, self).__init__()
 
         dims = [in_features] + hidden_dims
@@ -85,18 +137,19 @@ class GAT(nn.Module):
         gat_layers.append(GATConv(in_channels=dims[-2], out_channels=dims[-1]))
         self.gat_layers = nn.ModuleList(gat_layers)
 
-    def forward(self,
-                x: torch.Tensor,
-                edge_index: Union[torch.Tensor, list[torch.Tensor]],
-                ) -> torch.Tensor:
-        layerwise_adjacency = type(edge_index) == list
+        self.forward = self._forward_layerwise if layerwise_adjacency else self._forward_shared
+
+    def _forward_shared(self, x: torch.Tensor, edge_index: Adj) -> torch.Tensor:
+        return self._forward_layerwise(x, [edge_index] * len(self.gat_layers))
 
+    def _forward_layerwise(self,
+                           x: torch.Tensor,
+                           edge_index: list[Adj],
+                           ) -> torch.Tensor:
         for i, layer in enumerate(self.gat_layers[:-1], start=1):
-            edges = edge_index[-i] if layerwise_adjacency else edge_index
-            x = torch.relu(layer(x, edges))
+            x = torch.relu(layer(x, edge_index[-i]))
 
-        edges = edge_index[0] if layerwise_adjacency else edge_index
-        logits = self.gat_layers[-1](x, edges)
+        logits = self.gat_layers[-1](x, edge_index[0])
 
         return logits
 
@@ -105,8 +158,14 @@ class GCN2(nn.Module):
     def __init__(self, in_features: int,
                  hidden_dims: list[int],
                  alpha: float, theta: float,
-                 shared_weights=True, dropout=0.0):
+                 shared_weights=True, dropout=0.0,
+                 layerwise_adjacency: bool = False,
+                 num_checkpoint_segments: int = 2):
         super(GCN2, self).__init__()
+        # Activations of the hidden layers are checkpointed during training.
+        # With two hidden_dims there is a single hidden layer, and nothing
+        # is checkpointed.
+        self.num_checkpoint_segments = num_checkpoint_segments
 
         lins = []
         lins.append(Linear(in_features, hidden_dims[0]))
@@ -122,23 +181,31 @@ class GCN2(nn.Module):
         self.conv = nn.ModuleList(conv)
         self.dropout = dropout
 
-    def forward(self,
-                x: torch.Tensor,
-                edge_index: Union[torch.Tensor, list[torch.Tensor]],
-                ) -> torch.Tensor:
-        layerwise_adjacency = type(edge_index) == list
+        self.forward = self._forward_layerwise if layerwise_adjacency else self._forward_shared
 
+    def _forward_shared(self, x: torch.Tensor, edge_index: Adj) -> torch.Tensor:
+        return self._forward_layerwise(x, [edge_index] * len(self.conv))
+
+    def _hidden_layers(self, start: int, end: int, x: torch.Tensor,
+                       x_0: torch.Tensor, edge_index: list[Adj]) -> torch.Tensor:
+        for i in range(start, end):
+            x = F.dropout(x, self.dropout, training=self.training)
+            x = torch.relu(self.conv[i](x, x_0, edge_index[-(i + 1)]))
+        return x
+
+    def _forward_layerwise(self,
+                           x: torch.Tensor,
+                           edge_index: list[Adj],
+                           ) -> torch.Tensor:
         x = F.dropout(x, self.dropout, training=self.training)
         x = x_0 = self.lins[0](x).relu()
 
-        for i, layer in enumerate(self.conv[:-1], start=1):
-            edges = edge_index[-i] if layerwise_adjacency else edge_index
-            x = F.dropout(x, self.dropout, training=self.training)
-            x = torch.relu(layer(x, x_0, edges))
+        segments = self.num_checkpoint_segments if self.training else 1
+        x = checkpoint_segments(self._hidden_layers, len(self.conv) - 1,
+                                segments, x, x_0, edge_index)
 
-        edges = edge_index[0] if layerwise_adjacency else edge_index
         x = F.dropout(x, self.dropout, training=self.training)
-        x = self.conv[-1](x, x_0, edges)
+        x = self.conv[-1](x, x_0, edge_index[0])
 
         logits = self.lins[1](x)
 
@@ -149,8 +216,14 @@ class PNA(nn.Module):
     def __init__(self, in_features: int, hidden_dims: list[int],
                  aggregators: list[str], scalers: list[str], deg: torch.Tensor, dropout: float = 0.0,
                  drop_input: bool = True, batch_norm: bool = False,
-                 residual: bool = False, device=None):
+                 residual: bool = False, device=None,
+                 layerwise_adjacency: bool = False,
+                 num_checkpoint_segments: int = 2):
         super(PNA, self).__init__()
+        self.dropout = dropout
+        self.drop_input = drop_input
+        # Activations of the hidden layers are checkpointed during training
+        self.num_checkpoint_segments = num_checkpoint_segments
 
         dims = [in_features] + hidden_dims
         self.conv = nn.ModuleList()
@@ -161,18 +234,29 @@ class PNA(nn.Module):
 
         self.lins = Linear(in_features, hidden_dims[-1])
 
-    def forward(self, x: torch.Tensor, edge_index: Union[torch.Tensor, list[torch.Tensor]],
-                *args) -> torch.Tensor:
-        layerwise_adjacency = type(edge_index) == list
-        if self.drop_input:
-            x = F.dropout(x, p=self.dropout, training=self.training)
+        self.forward = self._forward_layerwise if layerwise_adjacency else self._forward_shared
+
+    def _forward_shared(self, x: torch.Tensor, edge_index: Adj,
+                        *args) -> torch.Tensor:
+        return self._forward_layerwise(x, [edge_index] * len(self.conv))
 
-        for i, layer in enumerate(self.conv[:-1], start=1):
-            edges = edge_index[-i] if layerwise_adjacency else edge_index
+    def _hidden_layers(self, start: int, end: int, x: torch.Tensor,
+                       edge_index: list[Adj]) -> torch.Tensor:
+        for i in range(start, end):
             x = self.lins(x) # not sure!
-            x = torch.relu(layer(x, edges))
+            x = torch.relu(self.conv[i](x, edge_index[-(i + 1)]))
             x = F.dropout(x, p=self.dropout, training=self.training)
+        return x
+
+    def _forward_layerwise(self, x: torch.Tensor, edge_index: list[Adj],
+                           *args) -> torch.Tensor:
+        if self.drop_input:
+            x = F.dropout(x, p=self.dropout, training=self.training)
+
+        segments = self.num_checkpoint_segments if self.training else 1
+        x = checkpoint_segments(self._hidden_layers, len(self.conv) - 1,
+                                segments, x, edge_index)
 
-        x = self.convs[-1](x,edge_index[-1])
+        x = self.conv[-1](x, edge_index[0])
         return x
 